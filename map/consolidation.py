@@ -0,0 +1,284 @@
+import dataclasses
+
+import trimesh
+
+import numpy as np
+
+
+# Vertices within this distance (in meters) of each other are merged when
+# welding overlapping spatial surfaces.
+DEFAULT_WELD_TOLERANCE = 0.01
+
+# Give up growing the clustering cell after this many attempts to reach a
+# triangle budget.
+MAX_DECIMATION_STEPS = 32
+
+DECIMATION_GROWTH = 1.5
+
+
+@dataclasses.dataclass
+class ConsolidationReport:
+    raw_vertices: int = 0
+    raw_faces: int = 0
+    vertices: int = 0
+    faces: int = 0
+
+    # Upper bound on the distance (in meters) between any vertex of the raw
+    # mesh and its representative in the consolidated mesh.
+    error_bound: float = 0.0
+
+
+def cluster_vertices(vertices, faces, cell_size):
+    """
+    Merge all vertices which fall in the same cubic grid cell.
+
+    Each cluster is replaced by the mean of its vertices, and faces are
+    reindexed accordingly.  Faces may become degenerate or duplicated, see
+    clean_faces.
+
+    Returns:
+        (V, 3) clustered vertices
+        (F, 3) reindexed faces
+        (N,) index of the clustered vertex for each input vertex
+        maximum distance moved by any input vertex
+    """
+    if len(vertices) == 0:
+        return vertices, faces, np.zeros(0, dtype=np.int64), 0.0
+
+    keys = np.floor(vertices / cell_size).astype(np.int64)
+    _, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    counts = np.bincount(inverse)
+    clustered = np.zeros((len(counts), 3))
+    np.add.at(clustered, inverse, vertices)
+    clustered /= counts[:, np.newaxis]
+
+    displacement = np.linalg.norm(vertices - clustered[inverse], axis=1)
+
+    return clustered, inverse[faces], inverse, float(displacement.max())
+
+
+def merge_close_vertices(vertices, faces, tolerance):
+    """
+    Merge vertices which are within tolerance of each other.
+
+    Vertices are hashed into cubic cells the size of the tolerance, and each
+    vertex is compared against the vertices in its own and the neighbouring
+    cells, so close vertices are found regardless of where the cell
+    boundaries fall.
+
+    Merging is not transitive.  Representatives are picked greedily in index
+    order, and each remaining vertex is merged into a representative within
+    tolerance of it, so no vertex moves further than tolerance.  Vertices
+    joined by an edge are never merged, so that welding does not collapse
+    the faces of a finely tessellated surface.  Faces may become duplicated,
+    see clean_faces.
+
+    Returns:
+        (V, 3) merged vertices
+        (F, 3) reindexed faces
+        (N,) index of the merged vertex for each input vertex
+        maximum distance moved by any input vertex
+    """
+    n = len(vertices)
+    if n == 0:
+        return vertices, faces, np.zeros(0, dtype=np.int64), 0.0
+
+    # Encode the integer cell coordinates as a single number so that the
+    # cell next to a vertex can be found by adding a fixed offset.
+    cells = np.floor(vertices / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    dims = cells.max(axis=0) + 2
+    codes = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+
+    # Only half of the neighbouring cells need to be checked, since a pair
+    # found from one side does not need to be found again from the other.
+    offsets = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                offset = (dx * dims[1] + dy) * dims[2] + dz
+                if offset >= 0:
+                    offsets.append(offset)
+
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    edge_codes = np.unique(edges[:, 0] * n + edges[:, 1])
+
+    first = []
+    second = []
+    for offset in offsets:
+        start = np.searchsorted(sorted_codes, codes + offset, side="left")
+        end = np.searchsorted(sorted_codes, codes + offset, side="right")
+        counts = end - start
+        if counts.sum() == 0:
+            continue
+
+        a = np.repeat(np.arange(n), counts)
+        b = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+
+        keep = (a < b) if offset == 0 else np.ones(len(a), dtype=bool)
+        low = np.minimum(a[keep], b[keep])
+        high = np.maximum(a[keep], b[keep])
+
+        close = np.linalg.norm(vertices[low] - vertices[high], axis=1) <= tolerance
+        close &= ~np.isin(low * n + high, edge_codes)
+        first.append(low[close])
+        second.append(high[close])
+
+    low = np.concatenate(first) if len(first) > 0 else np.zeros(0, dtype=np.int64)
+    high = np.concatenate(second) if len(second) > 0 else np.zeros(0, dtype=np.int64)
+
+    assigned = np.arange(n)
+    if len(low) > 0:
+        # Neighbour lists of close vertices in compressed sparse row form.
+        sources = np.concatenate([low, high])
+        targets = np.concatenate([high, low])
+        order = np.argsort(sources, kind="stable")
+        neighbours = targets[order]
+        indptr = np.searchsorted(sources[order], np.arange(n + 1))
+
+        edge_set = None
+        claimed = np.zeros(n, dtype=bool)
+        for i in np.unique(sources):
+            if claimed[i]:
+                continue
+            claimed[i] = True
+
+            candidates = neighbours[indptr[i]:indptr[i+1]]
+            candidates = np.unique(candidates[~claimed[candidates]])
+
+            # Two vertices joined by an edge must not end up in the same
+            # cluster either.
+            if len(candidates) > 1:
+                if edge_set is None:
+                    edge_set = set(edge_codes.tolist())
+                members = []
+                for j in candidates.tolist():
+                    if not any(min(j, m) * n + max(j, m) in edge_set for m in members):
+                        members.append(j)
+                candidates = np.array(members, dtype=np.int64)
+
+            assigned[candidates] = i
+            claimed[candidates] = True
+
+    representatives, inverse = np.unique(assigned, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    merged = vertices[representatives]
+
+    displacement = np.linalg.norm(vertices - merged[inverse], axis=1)
+
+    return merged, inverse[faces], inverse, float(displacement.max())
+
+
+def remove_unreferenced(vertices, faces):
+    """
+    Remove vertices which are not used by any face.
+
+    Returns the remaining vertices and the reindexed faces.
+    """
+    used, inverse = np.unique(faces, return_inverse=True)
+    return vertices[used], inverse.reshape(faces.shape)
+
+
+def clean_faces(vertices, faces):
+    """
+    Remove degenerate and duplicate faces.
+
+    A face is degenerate if it references the same vertex more than once or
+    has zero area.  Faces are duplicates if they reference the same three
+    vertices regardless of order or winding, in which case the first one is
+    kept.
+    """
+    if len(faces) == 0:
+        return faces
+
+    keep = (faces[:, 0] != faces[:, 1]) & \
+           (faces[:, 1] != faces[:, 2]) & \
+           (faces[:, 0] != faces[:, 2])
+    faces = faces[keep]
+
+    triangles = vertices[faces]
+    areas = np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0],
+                                    triangles[:, 2] - triangles[:, 0]), axis=1)
+    faces = faces[areas > 1e-12]
+
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    return faces[np.sort(first)]
+
+
+def weld(mesh, tolerance=DEFAULT_WELD_TOLERANCE):
+    """
+    Weld nearby vertices and drop degenerate and duplicate faces.
+
+    Returns the welded mesh and an upper bound on vertex displacement.
+    """
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    faces = np.asarray(mesh.faces, dtype=np.int64)
+
+    vertices, faces, _, error = merge_close_vertices(vertices, faces, tolerance)
+    faces = clean_faces(vertices, faces)
+    vertices, faces = remove_unreferenced(vertices, faces)
+
+    return trimesh.Trimesh(vertices=vertices, faces=faces, process=False), error
+
+
+def decimate(mesh, budget, tolerance=DEFAULT_WELD_TOLERANCE):
+    """
+    Reduce a mesh to at most budget triangles by vertex clustering.
+
+    The clustering cell grows geometrically from the weld tolerance until the
+    budget is met.  Returns the decimated mesh and an upper bound on vertex
+    displacement.  If the budget cannot be met, the coarsest attempt is
+    returned.
+    """
+    if budget is None or len(mesh.faces) <= budget:
+        return mesh, 0.0
+
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    faces = np.asarray(mesh.faces, dtype=np.int64)
+
+    cell_size = tolerance
+    for _ in range(MAX_DECIMATION_STEPS):
+        cell_size *= DECIMATION_GROWTH
+        new_vertices, new_faces, _, error = cluster_vertices(vertices, faces, cell_size)
+        new_faces = clean_faces(new_vertices, new_faces)
+        if len(new_faces) <= budget:
+            break
+
+    new_vertices, new_faces = remove_unreferenced(new_vertices, new_faces)
+    result = trimesh.Trimesh(vertices=new_vertices, faces=new_faces, process=False)
+    return result, error
+
+
+def consolidate(surfaces, budget=None, tolerance=DEFAULT_WELD_TOLERANCE):
+    """
+    Merge previously welded surfaces into a single mesh.
+
+    The surfaces are expected to come from weld, given as a list of
+    (mesh, error) tuples.  Vertices shared between overlapping surfaces are
+    welded, coincident faces are removed, and the result is decimated to the
+    triangle budget if one is given.
+
+    Returns the consolidated mesh and a ConsolidationReport.
+    """
+    report = ConsolidationReport()
+
+    meshes = [mesh for mesh, _ in surfaces]
+    surface_error = max((error for _, error in surfaces), default=0.0)
+
+    merged = trimesh.util.concatenate(meshes)
+    merged, merge_error = weld(merged, tolerance)
+    merged, decimate_error = decimate(merged, budget, tolerance)
+
+    report.vertices = len(merged.vertices)
+    report.faces = len(merged.faces)
+
+    # Each stage moves vertices by at most its own bound, so the total
+    # displacement is bounded by the sum.
+    report.error_bound = surface_error + merge_error + decimate_error
+
+    return merged, report
@@ -3,13 +3,25 @@ import dataclasses
 import os
 import pickle
 import tempfile
+import threading
 import time
 
 import requests
 import trimesh
+import xxhash
 
 import numpy as np
 
+from . import consolidation
+
+
+# Maximum number of locations for which consolidated meshes and welded
+# surfaces are kept in memory.
+CONSOLIDATED_LOCATIONS = 4
+
+# Maximum number of cached photo results kept for each location.
+MAX_RESULTS = 1000
+
 
 def download_file(url, output_path):
     res = requests.get(url)
@@ -19,15 +31,48 @@ def download_file(url, output_path):
 
 @dataclasses.dataclass
 class CacheContents:
+    results: int = 0
     surfaces: int = 0
     traces: int = 0
 
 
 class DataLoader:
-    def __init__(self, server="https://easyvizar.wings.cs.wisc.edu", cache_dir="cache"):
+    def __init__(self, server="https://easyvizar.wings.cs.wisc.edu", cache_dir="cache",
+                 consolidate=False, triangle_budget=None,
+                 weld_tolerance=consolidation.DEFAULT_WELD_TOLERANCE):
         self.server = server
         self.cache_dir = cache_dir
 
+        # Optional mesh consolidation stage for load_surfaces.  The triangle
+        # budget may be a single number or a dictionary mapping location_id
+        # to a number, with an optional "default" entry.  A budget of zero or
+        # None means the mesh is not decimated.
+        self.consolidate = consolidate
+        self.triangle_budget = triangle_budget
+        self.weld_tolerance = weld_tolerance
+
+        # Welded surfaces keyed by (location_id, surface_id), each stored with
+        # the version of the cached file it was built from, so that only
+        # changed surfaces need to be processed again.
+        self.welded_surfaces = {}
+
+        # Consolidated mesh for each location_id, stored with the surface
+        # versions and mesh version it was built from.  Ordered from least to
+        # most recently used so that old locations can be evicted.
+        self.consolidated_meshes = {}
+        self.consolidation_reports = {}
+
+        # Background rebuilds of consolidated meshes keyed by location_id.
+        # The lock protects the dictionaries above, and only one rebuild
+        # runs at a time.
+        self.pending_consolidations = {}
+        self.consolidation_lock = threading.RLock()
+        self.build_lock = threading.Lock()
+
+        # Version of the mesh most recently returned by load_surfaces for
+        # each location_id, see get_mesh_version.
+        self.mesh_versions = {}
+
     def cache_contents(self, location_id):
         """
         Check the cache contents for a given location_id.
@@ -36,13 +81,13 @@ class DataLoader:
 
         Example:
 
-            CacheContents(surfaces=376, traces=0)
+            CacheContents(results=12, surfaces=376, traces=0)
 
         """
         location_dir = os.path.join(self.cache_dir, location_id)
 
         contents = CacheContents()
-        for ctype in ["surfaces", "traces"]:
+        for ctype in ["results", "surfaces", "traces"]:
             path = os.path.join(location_dir, ctype)
             if os.path.exists(path):
                 setattr(contents, ctype, len(os.listdir(path)))
@@ -70,11 +115,12 @@ class DataLoader:
         file_name = "{}.pickle".format(surface_id)
         file_path = os.path.join(surfaces_dir, file_name)
 
-        try:
-            with open(file_path, "rb") as source:
-                return pickle.load(source)
-        except:
-            pass
+        if not ignore_cache:
+            try:
+                with open(file_path, "rb") as source:
+                    return pickle.load(source)
+            except:
+                pass
 
         # Avoid triggering server rate limit.
         time.sleep(0.2)
@@ -101,7 +147,69 @@ class DataLoader:
             # Avoid triggering server rate limit.
             time.sleep(0.2)
 
-            self.fetch_surface(location_id, item['id'])
+            self.fetch_surface(location_id, item['id'], ignore_cache=False)
+
+    def compute_mesh_version(self, location_id, surface_ids):
+        """
+        Compute a version string for the mesh made from the given surfaces.
+
+        The version depends on the list of surfaces, the cached file for each
+        surface, and the consolidation settings, but it does not require
+        loading any of the surfaces.
+        """
+        versions = [(surface_id, self.get_surface_version(location_id, surface_id)) for surface_id in surface_ids]
+        return self.hash_mesh_version(location_id, versions)
+
+    def hash_mesh_version(self, location_id, versions):
+        """
+        Compute a version string from a list of (surface_id, version) pairs.
+        """
+        digest = xxhash.xxh3_64()
+        if self.consolidate:
+            settings = (self.get_triangle_budget(location_id), self.weld_tolerance)
+            digest.update(repr(settings).encode())
+
+        for surface_id, version in sorted((str(sid), version) for sid, version in versions):
+            digest.update(repr((surface_id, version)).encode())
+
+        return digest.hexdigest()
+
+    def get_mesh_version(self, location_id):
+        """
+        Compute a version string for the current mesh of a given location.
+
+        The result matches mesh_versions[location_id] after load_surfaces if
+        no surface changed in between.
+        """
+        url = "{}/locations/{}/surfaces".format(self.server, location_id)
+        res = requests.get(url)
+
+        surface_ids = [item['id'] for item in res.json()]
+        return self.compute_mesh_version(location_id, surface_ids)
+
+    def get_triangle_budget(self, location_id):
+        if isinstance(self.triangle_budget, dict):
+            budget = self.triangle_budget.get(location_id, self.triangle_budget.get("default"))
+        else:
+            budget = self.triangle_budget
+
+        if not budget:
+            return None
+        return budget
+
+    def get_surface_version(self, location_id, surface_id):
+        """
+        Return a version token for a cached surface, or None if it is not cached.
+
+        The token changes whenever the cached file is rewritten.
+        """
+        file_name = "{}.pickle".format(surface_id)
+        file_path = os.path.join(self.cache_dir, location_id, "surfaces", file_name)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
 
     def load_cached_surfaces(self, location_id):
         """
@@ -140,7 +248,8 @@ class DataLoader:
         """
         Load all active surfaces from a given location.
 
-        Returns trimesh mesh containing all of the surfaces.
+        Returns trimesh mesh containing all of the surfaces.  The version of
+        the mesh is stored in mesh_versions[location_id].
         """
         surfaces_dir = os.path.join(self.cache_dir, location_id, "surfaces")
         os.makedirs(surfaces_dir, exist_ok=True)
@@ -149,13 +258,180 @@ class DataLoader:
 
         url = "{}/locations/{}/surfaces".format(self.server, location_id)
         res = requests.get(url)
-        for item in res.json():
-            mesh = self.fetch_surface(location_id, item['id'], ignore_cache=False)
-            if mesh is not None:
-                surfaces.append(mesh)
+        surface_ids = [item['id'] for item in res.json()]
+
+        if self.consolidate:
+            return self.load_consolidated_surfaces(location_id, surface_ids)
+
+        for surface_id in surface_ids:
+            surface = self.fetch_surface(location_id, surface_id, ignore_cache=False)
+            if surface is not None:
+                surfaces.append(surface)
+
+        self.mesh_versions[location_id] = self.compute_mesh_version(location_id, surface_ids)
 
         return trimesh.util.concatenate(surfaces)
 
+    def get_consolidation_state(self, location_id, surface_ids):
+        """
+        Describe the inputs of a consolidated mesh, for deciding whether it
+        needs to be rebuilt.
+        """
+        versions = tuple((surface_id, self.get_surface_version(location_id, surface_id)) for surface_id in surface_ids)
+        return (versions, self.get_triangle_budget(location_id), self.weld_tolerance)
+
+    def load_consolidated_surfaces(self, location_id, surface_ids):
+        """
+        Load surfaces from a given location with vertex welding, overlap
+        removal, and decimation to the location's triangle budget.
+
+        The first call for a location builds the mesh right away.  After
+        that, if any surface changed, the previous mesh is returned while a
+        new one is built in the background, so callers are not delayed by
+        the rebuild.
+
+        Returns trimesh mesh containing all of the surfaces.  The version of
+        the mesh is stored in mesh_versions[location_id].
+        """
+        state = self.get_consolidation_state(location_id, surface_ids)
+
+        with self.consolidation_lock:
+            previous = self.consolidated_meshes.pop(location_id, None)
+            if previous is not None:
+                self.consolidated_meshes[location_id] = previous
+
+        if previous is None:
+            previous = self.consolidate_surfaces(location_id, surface_ids)
+        elif previous[0] != state:
+            self.schedule_consolidation(location_id, surface_ids)
+
+        self.mesh_versions[location_id] = previous[2]
+        return previous[1]
+
+    def consolidate_surfaces(self, location_id, surface_ids):
+        """
+        Build the consolidated mesh for a given location.
+
+        Surfaces are welded individually and the results are kept in memory,
+        so only surfaces which changed since the last build are loaded and
+        welded again.  Welding across surfaces and decimation are repeated
+        for the whole location.
+
+        Returns a (state, mesh, mesh_version) tuple, which is also stored in
+        consolidated_meshes[location_id].  A ConsolidationReport is stored in
+        consolidation_reports[location_id].
+        """
+        with self.build_lock:
+            welded = []
+            versions = []
+            raw_vertices = 0
+            raw_faces = 0
+
+            # Drop surfaces which are no longer active in this location.
+            active = set((location_id, surface_id) for surface_id in surface_ids)
+            for key in list(self.welded_surfaces.keys()):
+                if key[0] == location_id and key not in active:
+                    del self.welded_surfaces[key]
+
+            for surface_id in surface_ids:
+                key = (location_id, surface_id)
+                version = self.get_surface_version(location_id, surface_id)
+
+                cached = self.welded_surfaces.get(key)
+                if version is None or cached is None or cached[0] != version:
+                    mesh = self.fetch_surface(location_id, surface_id, ignore_cache=False)
+                    if mesh is None:
+                        versions.append((surface_id, None))
+                        continue
+
+                    # Fetching may have created or replaced the cached file.
+                    version = self.get_surface_version(location_id, surface_id)
+                    mesh_welded, error = consolidation.weld(mesh, self.weld_tolerance)
+                    cached = (version, mesh_welded, error, len(mesh.vertices), len(mesh.faces))
+                    self.welded_surfaces[key] = cached
+
+                _, mesh_welded, error, nvertices, nfaces = cached
+                welded.append((mesh_welded, error))
+                versions.append((surface_id, cached[0]))
+                raw_vertices += nvertices
+                raw_faces += nfaces
+
+            budget = self.get_triangle_budget(location_id)
+            state = (tuple(versions), budget, self.weld_tolerance)
+            mesh_version = self.hash_mesh_version(location_id, versions)
+
+            mesh, report = consolidation.consolidate(welded, budget=budget, tolerance=self.weld_tolerance)
+            report.raw_vertices = raw_vertices
+            report.raw_faces = raw_faces
+            print("Consolidated surfaces: {}".format(report))
+
+            entry = (state, mesh, mesh_version)
+            with self.consolidation_lock:
+                self.consolidated_meshes.pop(location_id, None)
+                self.consolidated_meshes[location_id] = entry
+                self.consolidation_reports[location_id] = report
+
+                while len(self.consolidated_meshes) > CONSOLIDATED_LOCATIONS:
+                    self.evict_location(next(iter(self.consolidated_meshes)))
+
+            return entry
+
+    def schedule_consolidation(self, location_id, surface_ids=None):
+        """
+        Rebuild the consolidated mesh for a given location in the background.
+
+        If surface_ids is None, the list of active surfaces is requested from
+        the server first.  Nothing is done if a rebuild for the location is
+        already running.
+        """
+        with self.consolidation_lock:
+            if location_id in self.pending_consolidations:
+                return
+            thread = threading.Thread(target=self.run_consolidation, args=(location_id, surface_ids), daemon=True)
+            self.pending_consolidations[location_id] = thread
+        thread.start()
+
+    def run_consolidation(self, location_id, surface_ids):
+        try:
+            if surface_ids is None:
+                url = "{}/locations/{}/surfaces".format(self.server, location_id)
+                res = requests.get(url)
+                surface_ids = [item['id'] for item in res.json()]
+            self.consolidate_surfaces(location_id, surface_ids)
+        except Exception as error:
+            print("Warning: error consolidating surfaces for {}: {}".format(location_id, error))
+        finally:
+            with self.consolidation_lock:
+                self.pending_consolidations.pop(location_id, None)
+
+    def refresh_consolidation(self, location_id):
+        """
+        Start rebuilding the consolidated mesh for a location after one of
+        its surfaces changed, if the location has a consolidated mesh.
+        """
+        if self.consolidate and location_id in self.consolidated_meshes:
+            self.schedule_consolidation(location_id)
+
+    def wait_for_consolidation(self, location_id):
+        """
+        Block until a background rebuild for a given location has finished.
+        """
+        thread = self.pending_consolidations.get(location_id)
+        if thread is not None:
+            thread.join()
+
+    def evict_location(self, location_id):
+        """
+        Release consolidated meshes and welded surfaces held in memory for a
+        given location.
+        """
+        with self.consolidation_lock:
+            self.consolidated_meshes.pop(location_id, None)
+            self.consolidation_reports.pop(location_id, None)
+            for key in list(self.welded_surfaces.keys()):
+                if key[0] == location_id:
+                    del self.welded_surfaces[key]
+
     def load_traces(self, location_id):
         """
         Load user position history traces from server or cached files.
@@ -201,6 +477,61 @@ class DataLoader:
 
         return traces
 
+    def load_result(self, location_id, mesh_version, key):
+        """
+        Load a cached photo processing result, or return None if there is none.
+        """
+        file_name = "{}-{}.pickle".format(mesh_version, key)
+        file_path = os.path.join(self.cache_dir, location_id, "results", file_name)
+
+        try:
+            with open(file_path, "rb") as source:
+                return pickle.load(source)
+        except:
+            return None
+
+    def save_result(self, location_id, mesh_version, key, result, max_results=MAX_RESULTS):
+        """
+        Save a photo processing result to the cache.
+
+        Results for any other mesh version can no longer be used, so they
+        are deleted.  After that, the oldest results are deleted to keep at
+        most max_results for the location.
+        """
+        results_dir = os.path.join(self.cache_dir, location_id, "results")
+        os.makedirs(results_dir, exist_ok=True)
+
+        file_name = "{}-{}.pickle".format(mesh_version, key)
+        file_path = os.path.join(results_dir, file_name)
+
+        # Write to a temporary file first so that a partially written result
+        # is never loaded.
+        with tempfile.NamedTemporaryFile("wb", dir=results_dir, suffix=".tmp", delete=False) as output:
+            pickle.dump(result, output)
+        os.replace(output.name, file_path)
+
+        current = []
+        prefix = "{}-".format(mesh_version)
+        for fname in os.listdir(results_dir):
+            path = os.path.join(results_dir, fname)
+            if not fname.endswith(".pickle"):
+                continue
+            if fname.startswith(prefix):
+                current.append(path)
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        if len(current) > max_results:
+            current.sort(key=os.path.getmtime)
+            for path in current[:len(current) - max_results]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
     def set_photo_queue(self, photo_id, queue_name):
         data = {
             "queue_name": queue_name
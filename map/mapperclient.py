@@ -14,9 +14,12 @@ import quaternion
 import requests
 import trimesh
 import websocket
+import xxhash
 
-from .dataloader import DataLoader
+from .consolidation import DEFAULT_WELD_TOLERANCE
+from .dataloader import DataLoader, MAX_RESULTS
 from .photo import Photo
+from .snapshot import SnapshotExporter
 
 
 CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
@@ -70,17 +73,65 @@ def vertical_cylinder_transform(center):
     return transform
 
 
+def photo_result_key(photo, mesh_version, *settings):
+    """
+    Compute a key identifying the result of processing a photo.
+
+    The key covers everything which affects the result: the camera pose and
+    intrinsics, the annotation boundaries and contours, the version of the
+    location mesh, and any additional settings.
+    """
+    camera = photo.camera
+    position = photo.camera_position
+    orientation = photo.camera_orientation
+
+    data = [
+        mesh_version,
+        settings,
+        [camera.width, camera.height, camera.fx, camera.fy, camera.cx, camera.cy],
+        [position.x, position.y, position.z],
+        [orientation.x, orientation.y, orientation.z, orientation.w],
+    ]
+    for annotation in photo.annotations:
+        box = annotation.boundary
+        data.append([
+            annotation.id,
+            annotation.label,
+            [box.left, box.top, box.width, box.height],
+            annotation.contour
+        ])
+
+    return xxhash.xxh3_64_hexdigest(json.dumps(data).encode())
+
+
 class MapperClient:
     def __init__(self, server, config):
         self.server = server
         self.config = config
-        self.loader = DataLoader(server=server, cache_dir=CACHE_DIR)
+        self.loader = DataLoader(server=server, cache_dir=CACHE_DIR,
+                                 consolidate=config.get("enable-consolidation", False),
+                                 triangle_budget=config.get("triangle-budget", None),
+                                 weld_tolerance=config.get("weld-tolerance", DEFAULT_WELD_TOLERANCE))
 
         self.enable_contours = config.get("enable-contours", True)
         self.enable_features = config.get("enable-features", False)
+        self.enable_memoization = config.get("enable-memoization", False)
+        self.max_cached_results = config.get("max-cached-results", MAX_RESULTS)
         self.next_queue_name = config.get("next-queue-name", "done")
         self.queue_name = config.get("queue-name", "detection-3d")
 
+        # Debug mode builds a scene of the mesh and detected objects for each
+        # photo, which is shown if DISPLAY is set and exported to the
+        # snapshot directory if one is configured.
+        self.debug_mode = config.get("debug-mode", False)
+
+        self.snapshots = None
+        snapshot_dir = config.get("snapshot-dir")
+        if self.debug_mode and snapshot_dir is not None:
+            self.snapshots = SnapshotExporter(snapshot_dir,
+                                              min_interval=config.get("snapshot-interval", 0),
+                                              sample_rate=config.get("snapshot-sample-rate", 1.0))
+
     def on_close(self, ws, status_code, message):
         print("Connection closed with message: {} ({})".format(message, status_code))
 
@@ -158,8 +209,6 @@ class MapperClient:
         rot_mat = photo.camera_orientation.as_rotation_matrix()
         fx, fy, cx, cy = photo.camera.relative_parameters()
 
-        scene = mesh.scene()
-
         directions = []
         sizes = []
         for i, annotation in enumerate(photo.annotations):
@@ -189,8 +238,23 @@ class MapperClient:
         points, index_ray, index_tri = mesh.ray.intersects_location(origins, directions, multiple_hits=False)
         print(points)
         print(index_ray)
+
+        # Record of contours and features produced, which can be replayed
+        # later if the same photo is processed again.
+        result = dict(contours={}, features=[])
+
         if len(points) == 0:
-            return
+            return result
+
+        # Only pay for building the debug scene if it will be used.
+        show_scene = self.debug_mode and DISPLAY is not None
+        save_scene = self.snapshots is not None and self.snapshots.should_capture()
+        if show_scene or save_scene:
+            # The scene gets its own copy of the mesh because snapshots are
+            # exported from another thread while the mesh is still in use.
+            scene = mesh.copy().scene()
+        else:
+            scene = None
 
         features = self.loader.load_features(location_id)
         if len(features) > 0:
@@ -198,15 +262,16 @@ class MapperClient:
         else:
             feature_points = np.empty((0, 3))
 
-        # Axis at world coordinate system origin.
-        world_axis = trimesh.creation.axis(origin_size=0.2)
-        scene.add_geometry(world_axis)
+        if scene is not None:
+            # Axis at world coordinate system origin.
+            world_axis = trimesh.creation.axis(origin_size=0.2)
+            scene.add_geometry(world_axis)
 
-        cam = np.eye(4)
-        cam[0:3, 0:3] = rot_mat
-        cam[0:3, 3] = center
-        cam_axis = trimesh.creation.axis(origin_size=0.1, transform=cam, origin_color=[0, 0, 255, 255])
-        scene.add_geometry(cam_axis)
+            cam = np.eye(4)
+            cam[0:3, 0:3] = rot_mat
+            cam[0:3, 3] = center
+            cam_axis = trimesh.creation.axis(origin_size=0.1, transform=cam, origin_color=[0, 0, 255, 255])
+            scene.add_geometry(cam_axis)
 
         distances = np.linalg.norm(points - center, axis=1)
         sizes = distances[:, np.newaxis] * np.array(sizes)[index_ray, :]
@@ -231,33 +296,109 @@ class MapperClient:
             if self.enable_features and name in MARK_CLASSES and not cylinder_contains_any(feature_points, point, width, height):
                 marker_point = point + [0, half_height, 0]
                 self.loader.create_feature(location_id, "object", name, marker_point)
+                result['features'].append(dict(name=name, point=point.tolist(), width=float(width), height=float(height)))
 
                 # Append to the list of features from the server so that we do
                 # not create duplicate features even if the image has
                 # overlapping bounding boxes for some reason.
                 feature_points = np.vstack([feature_points, marker_point])
 
-            obj_transform = vertical_cylinder_transform(point)
-            marker = trimesh.creation.cylinder(radius=radius, height=height, transform=obj_transform, face_colors=[0, 255, 0, 128])
-            scene.add_geometry(marker)
+            if scene is not None:
+                obj_transform = vertical_cylinder_transform(point)
+                marker = trimesh.creation.cylinder(radius=radius, height=height, transform=obj_transform, face_colors=[0, 255, 0, 128])
+                scene.add_geometry(marker)
 
             if self.enable_contours and name not in EXCLUDE_CONTOURS and len(annotation.contour) > 0:
                 pcontour = self.project_contour(photo, np.array(annotation.contour), mesh, distance=distances[i])
                 self.loader.update_photo_annotation(annotation.id, projected_contour=pcontour.tolist())
+                result['contours'][annotation.id] = pcontour.tolist()
 
-                line = trimesh.path.entities.Line(list(range(len(pcontour))), color=[0, 0, 255, 255])
-                path = trimesh.path.path.Path3D([line], np.array(pcontour))
-                scene.add_geometry(path)
+                if scene is not None:
+                    line = trimesh.path.entities.Line(list(range(len(pcontour))), color=[0, 0, 255, 255])
+                    path = trimesh.path.path.Path3D([line], np.array(pcontour))
+                    scene.add_geometry(path)
 
-        if DISPLAY is not None:
+        if save_scene:
+            self.snapshots.submit("photo-{}".format(photo.id), scene)
+
+        if show_scene:
             scene.show()
 
+        return result
+
+    def replay_result(self, photo, result):
+        """
+        Apply a result from a previous run of find_objects_in_photo.
+
+        Only changes which are missing on the server are sent again, so this
+        is safe to call for a photo which was already fully processed.
+        """
+        location_id = str(photo.camera_location_id)
+
+        current = {annotation.id: annotation.projected_contour for annotation in photo.annotations}
+        for annotation_id, pcontour in result['contours'].items():
+            if current.get(annotation_id) != pcontour:
+                self.loader.update_photo_annotation(annotation_id, projected_contour=pcontour)
+
+        if len(result['features']) == 0:
+            return
+
+        features = self.loader.load_features(location_id)
+        if len(features) > 0:
+            feature_points = np.array([f['position'] for f in features])
+        else:
+            feature_points = np.empty((0, 3))
+
+        for feature in result['features']:
+            point = np.array(feature['point'])
+            width = feature['width']
+            height = feature['height']
+            if not cylinder_contains_any(feature_points, point, width, height):
+                marker_point = point + [0, 0.5 * height, 0]
+                self.loader.create_feature(location_id, "object", feature['name'], marker_point)
+                feature_points = np.vstack([feature_points, marker_point])
+
+    def process_photo(self, photo):
+        """
+        Find objects in a photo, reusing the result of a previous run if the
+        photo and location mesh are unchanged.
+        """
+        if not self.enable_memoization:
+            self.find_objects_in_photo(photo)
+            return
+
+        # Skip photos which find_objects_in_photo would ignore before
+        # checking the cache, since that requires a server request.
+        if not photo.is_situated() or len(photo.annotations) == 0 or photo.get_file("photo") is None:
+            return
+
+        location_id = str(photo.camera_location_id)
+        settings = (self.enable_contours, self.enable_features)
+
+        mesh_version = self.loader.get_mesh_version(location_id)
+        key = photo_result_key(photo, mesh_version, *settings)
+        result = self.loader.load_result(location_id, mesh_version, key)
+        if result is not None:
+            print("Replaying cached result for photo {}".format(photo.id))
+            self.replay_result(photo, result)
+            return
+
+        result = self.find_objects_in_photo(photo)
+        if result is None:
+            return
+
+        # Loading the mesh may have downloaded surfaces, so save the result
+        # under the version of the mesh which was actually used.
+        mesh_version = self.loader.mesh_versions[location_id]
+        key = photo_result_key(photo, mesh_version, *settings)
+        self.loader.save_result(location_id, mesh_version, key, result, max_results=self.max_cached_results)
+
     def on_photo_updated(self, data):
         photo = Photo.Schema(unknown=marshmallow.EXCLUDE).load(data['current'])
         if photo.queue_name != self.queue_name:
             return
 
-        self.find_objects_in_photo(photo)
+        self.process_photo(photo)
         self.loader.set_photo_queue(photo.id, self.next_queue_name)
 
     def on_surface_changed(self, data):
@@ -269,6 +410,7 @@ class MapperClient:
         surface_id = words[4]
 
         self.loader.fetch_surface(location_id, surface_id)
+        self.loader.refresh_consolidation(location_id)
 
     def run(self):
         if self.server.startswith("https"):
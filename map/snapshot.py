@@ -0,0 +1,83 @@
+import os
+import queue
+import random
+import threading
+import time
+
+
+class SnapshotExporter:
+    """
+    Export debug scenes as GLB files from a background thread.
+
+    Snapshots are rate limited to at most one every min_interval seconds and
+    optionally sampled with probability sample_rate.  Callers should check
+    should_capture before building a scene so that skipped snapshots cost
+    nothing.  If the export thread falls behind, new snapshots are dropped
+    rather than queued without bound.
+    """
+    def __init__(self, output_dir, min_interval=0, sample_rate=1.0, max_pending=4):
+        self.output_dir = output_dir
+        self.min_interval = min_interval
+        self.sample_rate = sample_rate
+
+        self.last_capture = None
+        self.pending = queue.Queue(maxsize=max_pending)
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def should_capture(self):
+        """
+        Decide whether the next snapshot should be captured.
+
+        Returns True at most once per min_interval seconds, and then only
+        with probability sample_rate.
+        """
+        now = time.monotonic()
+        if self.last_capture is not None and now - self.last_capture < self.min_interval:
+            return False
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+
+        self.last_capture = now
+        return True
+
+    def submit(self, name, scene):
+        """
+        Queue a scene to be exported as <name>.glb in the output directory.
+
+        Returns False if the snapshot was dropped.
+        """
+        try:
+            self.pending.put_nowait((name, scene))
+            return True
+        except queue.Full:
+            print("Warning: dropping snapshot {}, exporter is busy".format(name))
+            return False
+
+    def run(self):
+        while True:
+            name, scene = self.pending.get()
+            try:
+                self.export(name, scene)
+            except Exception as error:
+                print("Warning: error exporting snapshot {}: {}".format(name, error))
+            finally:
+                self.pending.task_done()
+
+    def export(self, name, scene):
+        file_path = os.path.join(self.output_dir, "{}.glb".format(name))
+        temp_path = file_path + ".tmp"
+
+        data = scene.export(file_type="glb")
+        with open(temp_path, "wb") as output:
+            output.write(data)
+        os.replace(temp_path, file_path)
+
+    def wait(self):
+        """
+        Block until all queued snapshots have been exported.
+        """
+        self.pending.join()
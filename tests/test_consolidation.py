@@ -0,0 +1,99 @@
+import numpy as np
+import trimesh
+
+from map import consolidation
+
+
+def test_weld_removes_overlap():
+    box = trimesh.creation.box()
+    merged = trimesh.util.concatenate([box, box.copy()])
+    assert len(merged.faces) == 2 * len(box.faces)
+
+    welded, error = consolidation.weld(merged)
+    assert len(welded.vertices) == len(box.vertices)
+    assert len(welded.faces) == len(box.faces)
+    assert error < consolidation.DEFAULT_WELD_TOLERANCE
+
+
+def test_clean_faces_drops_degenerate():
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [2, 0, 0]], dtype=float)
+    faces = np.array([[0, 1, 2], [2, 1, 0], [0, 0, 1], [0, 1, 3]])
+
+    faces = consolidation.clean_faces(vertices, faces)
+    assert faces.tolist() == [[0, 1, 2]]
+
+
+def test_consolidate_meets_budget():
+    sphere = trimesh.creation.icosphere(subdivisions=4)
+    surfaces = [consolidation.weld(sphere)]
+
+    mesh, report = consolidation.consolidate(surfaces, budget=500)
+    assert report.faces == len(mesh.faces)
+    assert report.faces <= 500
+
+    # Every raw vertex is within the reported bound of the decimated mesh.
+    distance = np.linalg.norm(sphere.vertices[:, np.newaxis] - mesh.vertices, axis=2)
+    assert np.all(distance.min(axis=1) <= report.error_bound + 1e-9)
+
+
+def test_weld_across_cell_boundary():
+    # The first vertices are 0.2 mm apart but fall in different cells of a
+    # grid the size of the weld tolerance.
+    vertices = np.array([
+        [0.0099, 0, 0], [1, 0, 0], [0, 1, 0],
+        [0.0101, 0, 0], [1, 0, 0], [0, 1, 0]
+    ])
+    faces = np.array([[0, 1, 2], [3, 4, 5]])
+    mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+    welded, error = consolidation.weld(mesh)
+    assert len(welded.vertices) == 3
+    assert len(welded.faces) == 1
+    assert error < consolidation.DEFAULT_WELD_TOLERANCE
+
+
+def test_weld_keeps_distant_vertices():
+    sphere = trimesh.creation.icosphere(subdivisions=3)
+
+    welded, error = consolidation.weld(sphere)
+    assert len(welded.vertices) == len(sphere.vertices)
+    assert len(welded.faces) == len(sphere.faces)
+    assert error == 0
+
+
+def test_weld_keeps_short_edges():
+    # Edges of 7.8 mm, shorter than the weld tolerance.
+    box = trimesh.creation.box(extents=[0.5, 0.5, 0.5])
+    for _ in range(6):
+        box = box.subdivide()
+    box.merge_vertices()
+
+    welded, error = consolidation.weld(box)
+    assert len(welded.vertices) == len(box.vertices)
+    assert len(welded.faces) == len(box.faces)
+    assert error == 0
+
+
+def test_merge_is_not_transitive():
+    # A line of points spaced closer than the tolerance must not collapse
+    # into a single point.
+    vertices = np.zeros((100, 3))
+    vertices[:, 0] = np.arange(100) * 0.009
+    faces = np.zeros((0, 3), dtype=np.int64)
+
+    merged, _, inverse, error = consolidation.merge_close_vertices(vertices, faces, 0.01)
+    assert len(merged) == 50
+    assert error <= 0.01
+
+    distance = np.linalg.norm(vertices - merged[inverse], axis=1)
+    assert np.all(distance <= 0.01)
+
+
+def test_weld_removes_unreferenced_vertices():
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [5, 5, 5]], dtype=float)
+    faces = np.array([[0, 1, 2], [0, 0, 3]])
+    mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+    welded, _ = consolidation.weld(mesh)
+    assert len(welded.vertices) == 3
+    assert len(welded.faces) == 1
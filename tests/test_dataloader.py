@@ -0,0 +1,65 @@
+import os
+import pickle
+
+import trimesh
+
+from map import dataloader
+
+
+def write_surfaces(cache_dir, location_id, count):
+    surfaces_dir = os.path.join(cache_dir, location_id, "surfaces")
+    os.makedirs(surfaces_dir, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(surfaces_dir, "{}.pickle".format(i)), "wb") as output:
+            pickle.dump(trimesh.creation.icosphere(subdivisions=2), output)
+
+
+def test_load_consolidated_surfaces(tmp_path):
+    write_surfaces(str(tmp_path), "a", 3)
+    loader = dataloader.DataLoader(cache_dir=str(tmp_path), consolidate=True)
+
+    mesh = loader.load_consolidated_surfaces("a", ["0", "1", "2"])
+    report = loader.consolidation_reports["a"]
+    assert report.raw_faces == 3 * len(mesh.faces)
+    assert report.faces == len(mesh.faces)
+    assert loader.load_consolidated_surfaces("a", ["0", "1", "2"]) is mesh
+
+    # The previous mesh is served while the new one is built, and surfaces
+    # which are no longer active are released.
+    loader.build_lock.acquire()
+    assert loader.load_consolidated_surfaces("a", ["0"]) is mesh
+    loader.build_lock.release()
+    loader.wait_for_consolidation("a")
+    assert list(loader.welded_surfaces.keys()) == [("a", "0")]
+
+    rebuilt = loader.load_consolidated_surfaces("a", ["0"])
+    assert len(rebuilt.faces) == report.raw_faces // 3
+    assert loader.mesh_versions["a"] == loader.compute_mesh_version("a", ["0"])
+
+
+def test_consolidated_locations_are_evicted(tmp_path):
+    loader = dataloader.DataLoader(cache_dir=str(tmp_path), consolidate=True)
+
+    locations = [str(i) for i in range(dataloader.CONSOLIDATED_LOCATIONS + 1)]
+    for location_id in locations:
+        write_surfaces(str(tmp_path), location_id, 1)
+        loader.load_consolidated_surfaces(location_id, ["0"])
+
+    assert list(loader.consolidated_meshes.keys()) == locations[1:]
+    assert ("0", "0") not in loader.welded_surfaces
+
+
+def test_save_result_eviction(tmp_path):
+    loader = dataloader.DataLoader(cache_dir=str(tmp_path))
+
+    loader.save_result("a", "v1", "x", {})
+    assert loader.load_result("a", "v1", "x") == {}
+
+    # Results for an older mesh version are deleted.
+    loader.save_result("a", "v2", "x", {})
+    assert loader.load_result("a", "v1", "x") is None
+    assert loader.cache_contents("a").results == 1
+
+    for key in ["y", "z"]:
+        loader.save_result("a", "v2", key, {}, max_results=2)
+    assert loader.cache_contents("a").results == 2
@@ -1,6 +1,54 @@
+import uuid
+
 import numpy as np
+import trimesh
 
 from map import mapperclient
+from map.dataloader import DataLoader
+from map.photo import Annotation, Box, Camera, File, Orientation, Photo, Position
+
+
+class StubLoader(DataLoader):
+    """
+    DataLoader which serves a fixed mesh and records server requests instead
+    of sending them.
+    """
+    def __init__(self, cache_dir, mesh):
+        super().__init__(cache_dir=cache_dir)
+        self.mesh = mesh
+        self.calls = []
+        self.features = []
+
+    def create_feature(self, location_id, feature_type, name, position):
+        self.calls.append("create_feature")
+        self.features.append(np.array(position))
+
+    def get_mesh_version(self, location_id):
+        return "v1"
+
+    def load_features(self, location_id):
+        return [dict(position=position) for position in self.features]
+
+    def load_surfaces(self, location_id):
+        self.calls.append("load_surfaces")
+        self.mesh_versions[location_id] = "v1"
+        return self.mesh
+
+    def update_photo_annotation(self, annotation_id, **data):
+        self.calls.append("update_photo_annotation")
+
+
+def make_photo():
+    return Photo(
+        id=1,
+        annotations=[Annotation(id=1, label="chair", boundary=Box(0.3, 0.3, 0.4, 0.4),
+                                contour=[[0.3, 0.3], [0.7, 0.3], [0.5, 0.7]])],
+        files=[File()],
+        camera=Camera(width=640, height=480, fx=500, fy=500, cx=320, cy=240),
+        camera_location_id=uuid.uuid4(),
+        camera_position=Position(0, 0, 0),
+        camera_orientation=Orientation(0, 0, 0, 1)
+    )
 
 
 def test_cylinder_contains_any():
@@ -13,3 +61,97 @@ def test_cylinder_contains_any():
 
     points = np.array([[10, 10, 10], x])
     assert mapperclient.cylinder_contains_any(points, x)
+
+
+def test_photo_result_key():
+    photo = Photo(
+        annotations=[Annotation(id=1, label="chair", boundary=Box(0.1, 0.1, 0.2, 0.2))],
+        camera=Camera(width=640, height=480, fx=500, fy=500, cx=320, cy=240),
+        camera_position=Position(1, 2, 3),
+        camera_orientation=Orientation(0, 0, 0, 1)
+    )
+
+    key = mapperclient.photo_result_key(photo, "v1")
+    assert key == mapperclient.photo_result_key(photo, "v1")
+    assert key != mapperclient.photo_result_key(photo, "v2")
+
+    photo.annotations[0].contour = [[0.1, 0.1], [0.2, 0.2]]
+    assert key != mapperclient.photo_result_key(photo, "v1")
+
+
+def test_process_photo_memoization(tmp_path):
+    config = {
+        "enable-features": True,
+        "enable-memoization": True
+    }
+    client = mapperclient.MapperClient("http://localhost:5000", config)
+    client.loader = StubLoader(str(tmp_path), trimesh.creation.box(extents=[10, 10, 10]))
+    photo = make_photo()
+
+    # Miss: the photo is processed against the mesh.
+    client.process_photo(photo)
+    assert client.loader.calls == ["load_surfaces", "create_feature", "update_photo_annotation"]
+
+    # Hit: the contour is sent again because the server does not have it
+    # yet, but the mesh is not loaded and the feature is not duplicated.
+    client.loader.calls = []
+    client.process_photo(photo)
+    assert client.loader.calls == ["update_photo_annotation"]
+
+    # Hit with the projected contour already on the server: nothing to do.
+    result = client.loader.load_result(str(photo.camera_location_id), "v1",
+        mapperclient.photo_result_key(photo, "v1", True, True))
+    photo.annotations[0].projected_contour = result['contours'][1]
+    client.loader.calls = []
+    client.process_photo(photo)
+    assert client.loader.calls == []
+
+
+def test_process_photo_skips_unprocessable(tmp_path):
+    client = mapperclient.MapperClient("http://localhost:5000", {"enable-memoization": True})
+    client.loader = StubLoader(str(tmp_path), trimesh.creation.box(extents=[10, 10, 10]))
+    client.loader.get_mesh_version = None
+
+    photo = make_photo()
+    photo.annotations = []
+    client.process_photo(photo)
+
+    photo = make_photo()
+    photo.files = []
+    client.process_photo(photo)
+
+    assert client.loader.calls == []
+
+
+def test_find_objects_without_debug_scene(tmp_path):
+    mesh = trimesh.creation.box(extents=[10, 10, 10])
+
+    def fail_scene(*args, **kwargs):
+        raise AssertionError("scene should not be built")
+
+    mesh.scene = fail_scene
+    mesh.copy = fail_scene
+
+    client = mapperclient.MapperClient("http://localhost:5000", {})
+    client.loader = StubLoader(str(tmp_path), mesh)
+
+    result = client.find_objects_in_photo(make_photo())
+    assert len(result['contours']) == 1
+
+
+def test_find_objects_miss_keeps_snapshot_slot(tmp_path):
+    # The box is behind the camera, so no ray hits it.
+    mesh = trimesh.creation.box(extents=[1, 1, 1])
+    mesh.apply_translation([0, 0, -5])
+
+    config = {
+        "debug-mode": True,
+        "snapshot-dir": str(tmp_path / "snapshots"),
+        "snapshot-interval": 3600
+    }
+    client = mapperclient.MapperClient("http://localhost:5000", config)
+    client.loader = StubLoader(str(tmp_path), mesh)
+
+    result = client.find_objects_in_photo(make_photo())
+    assert result == dict(contours={}, features=[])
+    assert client.snapshots.should_capture()
@@ -0,0 +1,27 @@
+import os
+
+import trimesh
+
+from map.snapshot import SnapshotExporter
+
+
+def test_snapshot_rate_limit(tmp_path):
+    exporter = SnapshotExporter(str(tmp_path), min_interval=3600)
+    assert exporter.should_capture()
+    assert not exporter.should_capture()
+
+    exporter = SnapshotExporter(str(tmp_path), sample_rate=0)
+    assert not exporter.should_capture()
+
+
+def test_snapshot_export(tmp_path):
+    exporter = SnapshotExporter(str(tmp_path))
+
+    scene = trimesh.creation.box().scene()
+    line = trimesh.path.entities.Line([0, 1, 2])
+    scene.add_geometry(trimesh.path.path.Path3D([line], [[0, 0, 0], [1, 0, 0], [1, 1, 0]]))
+
+    assert exporter.submit("photo-1", scene)
+    exporter.wait()
+
+    assert os.listdir(str(tmp_path)) == ["photo-1.glb"]